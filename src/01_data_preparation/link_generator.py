@@ -6,14 +6,28 @@ Ghi trực tiếp ra file để tránh out of memory
 
 import pandas as pd
 import numpy as np
-from math import radians, cos, sin, asin, sqrt
+import igraph as ig
+from sklearn.neighbors import BallTree
 import json
+import gzip
+import io
 import sys
 import os
+import pickle
+import hashlib
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
 import time
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from config import MAX_WORKERS, USE_MINIMAL_SAMPLE, MINIMAL_ROUTE_COUNT, PROCESSED_DATA_DIR
+
 # Configuration parameters
 CONFIG = {
     # Walking parameters
@@ -24,317 +38,600 @@ CONFIG = {
     # Transfer parameters  
     'MAX_TRANSFER_TIME': 1800,      # seconds - Thời gian chờ chuyển tuyến (30 phút)
     'MIN_TRANSFER_TIME': 120,       # seconds - Thời gian tối thiểu để chuyển (2 phút)
+    
+    # Parallel processing
+    'MAX_WORKERS': MAX_WORKERS,     # processes for WAIT/TRANSFER/WALK links (1 = in-process)
+    
+    # Development sample
+    'USE_MINIMAL_SAMPLE': USE_MINIMAL_SAMPLE,   # only build links for the first routes
+    'MINIMAL_ROUTE_COUNT': MINIMAL_ROUTE_COUNT, # number of routes kept in the sample
 }
 
-def haversine_distance(lat1, lon1, lat2, lon2):
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a))
-    r = 6371000
-    return c * r
+EARTH_RADIUS = 6371000  # meters
+
+# Node events are stored as int8 codes
+ARRIVAL = 0
+DEPARTURE = 1
+EVENT_CODES = {'ARRIVAL': ARRIVAL, 'DEPARTURE': DEPARTURE}
+
+# Bump when the layout of the load_stop_info() cache changes
+STOP_INFO_CACHE_VERSION = 4
+
+def stop_info_cache_file(json_file):
+    """Path of the load_stop_info() cache for json_file, kept in the processed data directory"""
+    path = os.path.abspath(json_file)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    path_hash = hashlib.sha256(path.encode()).hexdigest()[:12]
+    return os.path.join(PROCESSED_DATA_DIR, f'{stem}_{path_hash}_stop_info.pkl')
 
 def load_stop_info(json_file):
+    """
+    Load stops as parallel arrays: stop_ids, lat/lon (radians),
+    route_bits (routes served, bit i = route i) and index (stop_id -> position)
+    """
     print("Loading stop information...")
-    stop_info = {}
-    stop_routes = defaultdict(set)
+    cache_file = stop_info_cache_file(json_file)
+    if os.path.exists(cache_file) and os.path.getmtime(json_file) <= os.path.getmtime(cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, OSError) as e:
+            # A damaged cache is rebuilt (and overwritten) below
+            print(f"Ignoring unreadable stop info cache {cache_file}: {e}")
+            cached = (None, None)
+        if cached[0] == STOP_INFO_CACHE_VERSION:
+            stops = cached[1]
+            print(f"Loaded {len(stops['stop_ids'])} stops (cached)")
+            return stops
+    
+    stop_index = {}
+    lats, lngs, route_bits = [], [], []
+    route_to_bit = {}
     
     with open(json_file, 'r', encoding='utf-8') as f:
         data = json.load(f)
     
     for route_key, route_data in data.items():
         route_id = route_data.get('getroutebyid', {}).get('RouteId', route_key)
+        route_bit = 1 << route_to_bit.setdefault(route_id, len(route_to_bit))
         
         for variant in route_data.get('getvarsbyroute', []):
             variant_id = variant['RouteVarId']
-            stops = route_data.get('getstopsbyvar', {}).get(str(variant_id), [])
+            variant_stops = route_data.get('getstopsbyvar', {}).get(str(variant_id), [])
             
-            for stop in stops:
-                stop_id = stop['StopId']
-                if stop_id not in stop_info:
-                    stop_info[stop_id] = {
-                        'Lat': stop['Lat'],
-                        'Lng': stop['Lng'],
-                        'Name': stop['Name'],
-                        'Routes': set()
-                    }
-                stop_info[stop_id]['Routes'].add(route_id)
-                stop_routes[stop_id].add(route_id)
-    
-    for stop_id in stop_info:
-        stop_info[stop_id]['Routes'] = list(stop_info[stop_id]['Routes'])
-    
-    print(f"Loaded {len(stop_info)} stops")
-    return stop_info, stop_routes
-
-def find_stops_within_radius(center_stop_id, stop_info, radius):
-    center = stop_info[center_stop_id]
-    nearby_stops = []
-    
-    for stop_id, stop in stop_info.items():
-        if stop_id != center_stop_id:
-            distance = haversine_distance(
-                center['Lat'], center['Lng'],
-                stop['Lat'], stop['Lng']
-            )
-            if distance <= radius:
-                nearby_stops.append({
-                    'StopId': stop_id,
-                    'Distance': distance,
-                    'Name': stop['Name']
-                })
-    
-    return nearby_stops
-
-def create_bus_links_to_file(node_df, output_file, start_link_id=1):
+            for stop in variant_stops:
+                i = stop_index.setdefault(stop['StopId'], len(stop_index))
+                if i == len(lats):
+                    lats.append(stop['Lat'])
+                    lngs.append(stop['Lng'])
+                    route_bits.append(0)
+                route_bits[i] |= route_bit
+    
+    lat = np.radians(np.array(lats, dtype=np.float64))
+    lon = np.radians(np.array(lngs, dtype=np.float64))
+    stops = {
+        'stop_ids': np.fromiter(stop_index.keys(), dtype=np.int32, count=len(stop_index)),
+        'lat': lat,
+        'lon': lon,
+        'route_bits': route_bits,
+        'index': stop_index
+    }
+    
+    # The cache is only an optimization, a read-only data directory must not fail the run.
+    # Write to a temporary file and rename it, so an interrupted run never leaves a partial cache.
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_file, 'wb') as f:
+            pickle.dump((STOP_INFO_CACHE_VERSION, stops), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print(f"Could not write stop info cache {cache_file}: {e}")
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    
+    print(f"Loaded {len(stop_index)} stops on {len(route_to_bit)} routes")
+    return stops
+
+def build_neighbor_index(stops, radius):
+    """Map each stop_id to (neighbor_ids, distances) of the stops within radius"""
+    coords = np.column_stack([stops['lat'], stops['lon']])
+    tree = BallTree(coords, metric='haversine')
+    indices, distances = tree.query_radius(coords, r=radius / EARTH_RADIUS, return_distance=True)
+    
+    stop_ids = stops['stop_ids']
+    neighbor_index = {}
+    for i, stop_id in enumerate(stop_ids):
+        order = np.argsort(indices[i])
+        nearby = indices[i][order]
+        keep = stop_ids[nearby] != stop_id
+        neighbor_index[stop_id] = (stop_ids[nearby[keep]], distances[i][order][keep] * EARTH_RADIUS)
+    
+    return neighbor_index
+
+def create_bus_links_to_file(node_df, writer, start_link_id=1):
     """Create BUS links and write directly to file"""
     print("\nCreating BUS links...")
     
-    # Write header
-    with open(output_file, 'w') as f:
-        f.write('link_id,from_node,to_node,duration,mode\n')
-    
-    link_id = start_link_id
-    link_count = 0
-    chunk_size = 10000
-    chunk_links = []
+    # Pair every node with the next node of the same trip
+    trips = node_df.sort_values(['RouteId', 'TripId', 'Timestamp'], kind='stable')
+    grouped = trips.groupby(['RouteId', 'TripId'], sort=False)
+    next_ts = grouped['Timestamp'].shift(-1)
+    next_node = grouped['NodeId'].shift(-1)
+    next_event = grouped['Event'].shift(-1)
+    time_diff = next_ts - trips['Timestamp']
+    
+    mask = (
+        (trips['Event'] == DEPARTURE) &
+        (next_event == ARRIVAL) &
+        (time_diff < 1800)
+    )
+    link_count = int(mask.sum())
+    
+    next_link_id = writer.write(
+        start_link_id,
+        trips['NodeId'][mask].to_numpy(),
+        next_node[mask].to_numpy(dtype=np.int32),
+        time_diff[mask].to_numpy(dtype=np.int32),
+        'bus'
+    )
     
-    grouped = node_df.groupby(['RouteId', 'TripId'])
+    print(f"Created {link_count} BUS links")
+    return next_link_id
+
+def expand_ranges(lo, hi):
+    """Expand half-open ranges [lo[i], hi[i]) into (owner, index) pairs"""
+    counts = np.maximum(hi - lo, 0)
+    owners = np.repeat(np.arange(len(lo)), counts)
+    offsets = np.cumsum(counts) - counts
+    indices = np.arange(counts.sum()) - np.repeat(offsets - lo, counts)
+    return owners, indices
+
+# Link modes are stored as int8 codes into this dictionary
+LINK_MODES = ['bus', 'wait', 'transfer', 'walk']
+LINK_MODE_CODES = {mode: code for code, mode in enumerate(LINK_MODES)}
+
+LINK_SCHEMA = pa.schema([
+    ('link_id', pa.int32()),
+    ('from_node', pa.int32()),
+    ('to_node', pa.int32()),
+    ('duration', pa.int32()),
+    ('mode', pa.dictionary(pa.int8(), pa.string()))
+])
+
+# CSV text is collected in memory and written out in blocks of this size
+CSV_BUFFER_BYTES = 16 << 20
+
+class LinkWriter:
+    """Buffer links in columnar arrays and flush them to a CSV, gzipped CSV or Parquet (by extension) link table"""
     
-    for (route_id, trip_id), trip_nodes in grouped:
-        trip_nodes = trip_nodes.sort_values('Timestamp')
-        departures = trip_nodes[trip_nodes['Event'] == 'DEPARTURE'].reset_index()
-        arrivals = trip_nodes[trip_nodes['Event'] == 'ARRIVAL'].reset_index()
+    def __init__(self, output_file, metadata=None, chunk_size=50000):
+        self.output_file = output_file
+        self.chunk_size = chunk_size
+        self.mode_counts = defaultdict(int)
         
-        for i in range(len(departures)):
-            dep_time = departures.iloc[i]['Timestamp']
-            dep_node = departures.iloc[i]['NodeId']
-            
-            next_arrivals = arrivals[arrivals['Timestamp'] > dep_time]
+        self.link_id = np.empty(chunk_size, dtype=np.int32)
+        self.from_node = np.empty(chunk_size, dtype=np.int32)
+        self.to_node = np.empty(chunk_size, dtype=np.int32)
+        self.duration = np.empty(chunk_size, dtype=np.int32)
+        self.mode = np.empty(chunk_size, dtype=np.int8)
+        self.size = 0
+        
+        self.schema = LINK_SCHEMA.with_metadata(metadata or {})
+        if output_file.endswith('.parquet'):
+            # zstd level 3: several times smaller than CSV at little CPU cost
+            self.parquet_writer = pq.ParquetWriter(output_file, self.schema,
+                                                   compression='zstd', compression_level=3)
+            self.sink = None
+            self.fd = None
+        else:
+            self.parquet_writer = None
+            if output_file.endswith('.gz'):
+                self.sink = gzip.open(output_file, 'wb', compresslevel=1)
+                self.fd = None
+            else:
+                self.sink = None
+                self.fd = os.open(output_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            self.csv_buffer = io.BytesIO()
+            self.csv_buffer.write(b'link_id,from_node,to_node,duration,mode\n')
+    
+    def write(self, start_link_id, from_nodes, to_nodes, durations, mode):
+        """Append a block of links of one mode, return next link_id"""
+        n = len(from_nodes)
+        code = LINK_MODE_CODES[mode]
+        
+        done = 0
+        while done < n:
+            take = min(n - done, self.chunk_size - self.size)
+            lo, hi = self.size, self.size + take
+            self.link_id[lo:hi] = np.arange(start_link_id + done, start_link_id + done + take)
+            self.from_node[lo:hi] = from_nodes[done:done + take]
+            self.to_node[lo:hi] = to_nodes[done:done + take]
+            self.duration[lo:hi] = durations[done:done + take]
+            self.mode[lo:hi] = code
+            self.size = hi
+            done += take
             
-            if not next_arrivals.empty:
-                next_arrival = next_arrivals.iloc[0]
-                time_diff = next_arrival['Timestamp'] - dep_time
-                
-                if time_diff < 1800:
-                    chunk_links.append({
-                        'link_id': link_id,
-                        'from_node': dep_node,
-                        'to_node': next_arrival['NodeId'],
-                        'duration': time_diff,
-                        'mode': 'bus'
-                    })
-                    link_id += 1
-                    link_count += 1
-                    
-                    # Write chunk to file
-                    if len(chunk_links) >= chunk_size:
-                        df_chunk = pd.DataFrame(chunk_links)
-                        df_chunk.to_csv(output_file, mode='a', header=False, index=False)
-                        chunk_links = []
-    
-    # Write remaining links
-    if chunk_links:
-        df_chunk = pd.DataFrame(chunk_links)
-        df_chunk.to_csv(output_file, mode='a', header=False, index=False)
+            if self.size == self.chunk_size:
+                self.flush()
+        
+        self.mode_counts[mode] += n
+        return start_link_id + n
     
-    print(f"Created {link_count} BUS links")
-    return link_id
+    def flush(self):
+        """Write buffered links to the output file"""
+        if self.size == 0:
+            return
+        
+        n = self.size
+        table = pa.Table.from_arrays([
+            pa.array(self.link_id[:n]),
+            pa.array(self.from_node[:n]),
+            pa.array(self.to_node[:n]),
+            pa.array(self.duration[:n]),
+            pa.DictionaryArray.from_arrays(pa.array(self.mode[:n]), LINK_MODES)
+        ], schema=self.schema)
+        
+        if self.parquet_writer is not None:
+            self.parquet_writer.write_table(table)
+        else:
+            pa_csv.write_csv(table, self.csv_buffer, pa_csv.WriteOptions(include_header=False, quoting_style='none'))
+            if self.csv_buffer.tell() >= CSV_BUFFER_BYTES:
+                self.drain_csv_buffer()
+        self.size = 0
+    
+    def drain_csv_buffer(self):
+        """Write the buffered CSV text to the output file in one call"""
+        data = self.csv_buffer.getvalue()
+        if self.fd is not None:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self.fd, view):]
+        else:
+            self.sink.write(data)
+        self.csv_buffer.seek(0)
+        self.csv_buffer.truncate()
+    
+    def close(self):
+        self.flush()
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+            return
+        self.drain_csv_buffer()
+        if self.fd is not None:
+            os.close(self.fd)
+        else:
+            self.sink.close()
+
+def source_fingerprint(*files):
+    """Hash of input file mtimes/sizes and CONFIG, used to detect a stale link table"""
+    state = [(os.path.abspath(f), os.path.getmtime(f), os.path.getsize(f)) for f in files]
+    state.append(sorted(CONFIG.items()))
+    return hashlib.sha256(json.dumps(state, default=str).encode()).hexdigest()
+
+def is_link_table_current(output_file, fingerprint):
+    """True if output_file is a Parquet link table built from the same sources"""
+    if not output_file.endswith('.parquet') or not os.path.exists(output_file):
+        return False
+    try:
+        metadata = pq.read_schema(output_file).metadata or {}
+    except pa.ArrowInvalid:
+        return False
+    return metadata.get(b'source_hash') == fingerprint.encode()
+
+def graph_file_for(link_file):
+    """Path of the binary graph written next to a link table (out.parquet -> out.parquet.picklez)"""
+    return link_file + '.picklez'
+
+def is_graph_current(graph_file, fingerprint):
+    """True if graph_file was built from a link table with the same source fingerprint"""
+    if not os.path.exists(graph_file):
+        return False
+    graph = ig.Graph.Read_Picklez(graph_file)
+    return 'source_hash' in graph.attributes() and graph['source_hash'] == fingerprint
+
+def read_link_batches(link_file):
+    """Stream (from_node, to_node, duration, mode) record batches from a link table"""
+    columns = ['from_node', 'to_node', 'duration', 'mode']
+    if link_file.endswith('.parquet'):
+        return pq.ParquetFile(link_file).iter_batches(columns=columns)
+    column_types = {name: LINK_SCHEMA.field(name).type for name in columns}
+    # The CSV reader only dictionary-encodes with int32 indices
+    column_types['mode'] = pa.dictionary(pa.int32(), pa.string())
+    convert_options = pa_csv.ConvertOptions(include_columns=columns, column_types=column_types)
+    return pa_csv.open_csv(link_file, convert_options=convert_options)
 
-def append_wait_links_to_file(node_df, output_file, start_link_id):
+def save_graph_binary(link_file, graph_file, first_node_id, last_node_id, source_hash):
+    """Load the link table into a directed igraph graph and save it as .picklez
+    
+    Vertex i is NodeId first_node_id + i; the edge 'mode' attribute holds the
+    int8 code into the graph's 'modes' list (LINK_MODES). source_hash is the
+    link table's fingerprint, used to detect a graph left over from another build.
+    """
+    sources, targets, durations, modes = [], [], [], []
+    for batch in read_link_batches(link_file):
+        mode = batch.column('mode')
+        # Re-code each batch's dictionary to LINK_MODE_CODES; the dictionary order is per file/batch
+        recode = np.array([LINK_MODE_CODES[m] for m in mode.dictionary.to_pylist()], dtype=np.int8)
+        sources.append(batch.column('from_node').to_numpy() - first_node_id)
+        targets.append(batch.column('to_node').to_numpy() - first_node_id)
+        durations.append(batch.column('duration').to_numpy())
+        modes.append(recode[mode.indices.to_numpy()])
+    
+    edges = np.column_stack([np.concatenate(sources), np.concatenate(targets)])
+    del sources, targets
+    graph = ig.Graph(n=last_node_id - first_node_id + 1, edges=edges, directed=True)
+    del edges
+    graph.es['duration'] = np.concatenate(durations).tolist()
+    del durations
+    graph.es['mode'] = np.concatenate(modes).tolist()
+    graph['modes'] = LINK_MODES
+    graph['node_id_offset'] = first_node_id
+    graph['source_hash'] = source_hash
+    graph.write_picklez(graph_file)
+    print(f"Graph saved to: {graph_file} ({graph.vcount():,} vertices, {graph.ecount():,} edges)")
+
+def stop_slices(stop_ids, lo, hi):
+    """Map each stop_id to its slice of the run stop_ids[lo:hi], which must be sorted"""
+    ids, starts = np.unique(stop_ids[lo:hi], return_index=True)
+    ends = np.append(starts[1:], hi - lo)
+    return {stop_id: slice(lo + start, lo + end) for stop_id, start, end in zip(ids, starts, ends)}
+
+def build_stop_data(node_df):
+    """Split nodes per stop into arrival/departure arrays sorted by Timestamp"""
+    # One stable sort: arrivals then departures, each grouped by stop and time-ordered
+    order = np.lexsort((node_df['Timestamp'].to_numpy(), node_df['StopId'].to_numpy(), node_df['Event'].to_numpy()))
+    event = node_df['Event'].to_numpy()[order]
+    stop = node_df['StopId'].to_numpy()[order]
+    ts = node_df['Timestamp'].to_numpy()[order]
+    node = node_df['NodeId'].to_numpy()[order]
+    route = node_df['RouteId'].to_numpy()[order]
+    
+    n_arr = np.searchsorted(event, DEPARTURE)
+    arr_slices = stop_slices(stop, 0, n_arr)
+    dep_slices = stop_slices(stop, n_arr, len(stop))
+    
+    # Per-stop arrays are views into the sorted columns
+    stop_data = {}
+    empty = slice(0, 0)
+    for stop_id in np.union1d(list(arr_slices), list(dep_slices)):
+        arr = arr_slices.get(stop_id, empty)
+        dep = dep_slices.get(stop_id, empty)
+        stop_data[stop_id] = {
+            'arr_ts': ts[arr],
+            'arr_node': node[arr],
+            'arr_route': route[arr],
+            'dep_ts': ts[dep],
+            'dep_node': node[dep],
+            'dep_route': route[dep]
+        }
+    
+    return stop_data
+
+# Read-only inputs shared with worker processes, set by init_worker()
+_worker_state = {}
+
+# Shards submitted per worker ahead of the writer; finished results wait in memory until written
+SHARDS_IN_FLIGHT_PER_WORKER = 2
+
+def init_worker(state):
+    _worker_state.update(state)
+
+def map_shards(task, shards, state, max_workers):
+    """Run task over shards, in a process pool if max_workers > 1, yielding results in order
+    
+    At most max_workers * SHARDS_IN_FLIGHT_PER_WORKER shards are pending at a time, so
+    finished link arrays do not pile up in the parent while the writer formats them.
+    """
+    if max_workers > 1:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                 initargs=(state,)) as pool:
+            pending = deque()
+            for shard in shards:
+                if len(pending) >= max_workers * SHARDS_IN_FLIGHT_PER_WORKER:
+                    yield pending.popleft().result()
+                pending.append(pool.submit(task, shard))
+            while pending:
+                yield pending.popleft().result()
+    else:
+        init_worker(state)
+        try:
+            yield from map(task, shards)
+        finally:
+            # Drop the references so node/stop arrays are not kept alive after the run
+            _worker_state.clear()
+
+def split_shards(items, max_workers):
+    """Split items into enough shards to keep every worker busy"""
+    n_shards = min(len(items), max(max_workers, 1) * 8)
+    return [shard for shard in np.array_split(np.asarray(items), max(n_shards, 1)) if len(shard)]
+
+def concat_links(from_parts, to_parts, duration_parts):
+    if not from_parts:
+        empty = np.empty(0, dtype=np.int32)
+        return empty, empty, empty
+    return np.concatenate(from_parts), np.concatenate(to_parts), np.concatenate(duration_parts)
+
+def wait_links_for_groups(groups):
+    """WAIT links (from, to, duration) for a shard of (StopId, RouteId) groups"""
+    ts = _worker_state['ts']
+    node = _worker_state['node']
+    event = _worker_state['event']
+    group_starts = _worker_state['group_starts']
+    group_ends = _worker_state['group_ends']
+    from_parts, to_parts, duration_parts = [], [], []
+    
+    for g in groups:
+        group = slice(group_starts[g], group_ends[g])
+        is_arr = event[group] == ARRIVAL
+        is_dep = event[group] == DEPARTURE
+        arr_ts, arr_node = ts[group][is_arr], node[group][is_arr]
+        dep_ts, dep_node = ts[group][is_dep], node[group][is_dep]
+        
+        # Every arrival links to all strictly later departures
+        first_dep = np.searchsorted(dep_ts, arr_ts, side='right')
+        arr_idx, dep_idx = expand_ranges(first_dep, np.full(len(arr_ts), len(dep_ts)))
+        
+        from_parts.append(arr_node[arr_idx])
+        to_parts.append(dep_node[dep_idx])
+        duration_parts.append(dep_ts[dep_idx] - arr_ts[arr_idx])
+    
+    return concat_links(from_parts, to_parts, duration_parts)
+
+def append_wait_links_to_file(node_df, writer, start_link_id, max_workers):
     """Create WAIT links and append to file"""
     print("\nCreating WAIT links...")
     
     link_id = start_link_id
-    link_count = 0
-    chunk_size = 50000
-    chunk_links = []
-    
-    grouped = node_df.groupby(['StopId', 'RouteId'])
-    total_groups = len(grouped)
-    processed = 0
-    
-    for (stop_id, route_id), stop_nodes in grouped:
-        processed += 1
-        if processed % 1000 == 0:
-            print(f"  Processing group {processed}/{total_groups}...")
-            
-        arrivals = stop_nodes[stop_nodes['Event'] == 'ARRIVAL'].sort_values('Timestamp')
-        departures = stop_nodes[stop_nodes['Event'] == 'DEPARTURE'].sort_values('Timestamp')
-        
-        for _, arrival in arrivals.iterrows():
-            arr_time = arrival['Timestamp']
-            arr_node = arrival['NodeId']
-            
-            future_deps = departures[departures['Timestamp'] > arr_time]
-            
-            for _, departure in future_deps.iterrows():
-                dep_time = departure['Timestamp']
-                wait_time = dep_time - arr_time
-                
-                chunk_links.append({
-                    'link_id': link_id,
-                    'from_node': arr_node,
-                    'to_node': departure['NodeId'],
-                    'duration': wait_time,
-                    'mode': 'wait'
-                })
-                link_id += 1
-                link_count += 1
-                
-                if len(chunk_links) >= chunk_size:
-                    df_chunk = pd.DataFrame(chunk_links)
-                    df_chunk.to_csv(output_file, mode='a', header=False, index=False)
-                    chunk_links = []
-    
-    if chunk_links:
-        df_chunk = pd.DataFrame(chunk_links)
-        df_chunk.to_csv(output_file, mode='a', header=False, index=False)
-    
-    print(f"Created {link_count} WAIT links")
+    
+    # Sort once; each (StopId, RouteId) group is then a contiguous, time-ordered slice
+    events = node_df.sort_values(['StopId', 'RouteId', 'Timestamp'], kind='stable')
+    keys = events[['StopId', 'RouteId']].to_numpy()
+    boundaries = np.flatnonzero((keys[1:] != keys[:-1]).any(axis=1)) + 1
+    group_starts = np.concatenate([[0], boundaries])
+    group_ends = np.concatenate([boundaries, [len(events)]])
+    print(f"Processing {len(group_starts)} stop/route groups...")
+    
+    shards = split_shards(np.arange(len(group_starts)), max_workers)
+    state = {
+        'ts': events['Timestamp'].to_numpy(),
+        'node': events['NodeId'].to_numpy(),
+        'event': events['Event'].to_numpy(),
+        'group_starts': group_starts,
+        'group_ends': group_ends
+    }
+    
+    for processed, links in enumerate(map_shards(wait_links_for_groups, shards, state, max_workers), 1):
+        link_id = writer.write(link_id, *links, 'wait')
+        print(f"  Processed shard {processed}/{len(shards)}...")
+    
+    print(f"Created {link_id - start_link_id} WAIT links")
     return link_id
 
-def append_transfer_links_to_file(node_df, output_file, start_link_id, max_transfer_time):
+def transfer_links_for_stops(stop_ids):
+    """TRANSFER links (from, to, duration) for a shard of stops"""
+    stop_data = _worker_state['stop_data']
+    min_transfer_time = _worker_state['min_transfer_time']
+    max_transfer_time = _worker_state['max_transfer_time']
+    from_parts, to_parts, duration_parts = [], [], []
+    
+    for stop_id in stop_ids:
+        data = stop_data[stop_id]
+        arr_ts, arr_node, arr_route = data['arr_ts'], data['arr_node'], data['arr_route']
+        dep_ts, dep_node, dep_route = data['dep_ts'], data['dep_node'], data['dep_route']
+        
+        # Departures later than arr_time, within [min_transfer_time, max_transfer_time] of it
+        lo = np.maximum(
+            np.searchsorted(dep_ts, arr_ts, side='right'),
+            np.searchsorted(dep_ts, arr_ts + min_transfer_time, side='left')
+        )
+        hi = np.searchsorted(dep_ts, arr_ts + max_transfer_time, side='right')
+        arr_idx, dep_idx = expand_ranges(lo, hi)
+        
+        other_route = dep_route[dep_idx] != arr_route[arr_idx]
+        arr_idx, dep_idx = arr_idx[other_route], dep_idx[other_route]
+        
+        from_parts.append(arr_node[arr_idx])
+        to_parts.append(dep_node[dep_idx])
+        duration_parts.append(dep_ts[dep_idx] - arr_ts[arr_idx])
+    
+    return concat_links(from_parts, to_parts, duration_parts)
+
+def append_transfer_links_to_file(stop_data, writer, start_link_id, min_transfer_time, max_transfer_time,
+                                  max_workers):
     """Create TRANSFER links and append to file"""
     print("\nCreating TRANSFER links...")
     
     link_id = start_link_id
-    link_count = 0
-    chunk_size = 50000
-    chunk_links = []
-    
-    grouped = node_df.groupby('StopId')
-    total_stops = len(grouped)
-    processed = 0
-    
-    for stop_id, stop_nodes in grouped:
-        processed += 1
-        if processed % 500 == 0:
-            print(f"  Processing stop {processed}/{total_stops}...")
-            
-        arrivals = stop_nodes[stop_nodes['Event'] == 'ARRIVAL'].sort_values('Timestamp')
-        departures = stop_nodes[stop_nodes['Event'] == 'DEPARTURE'].sort_values('Timestamp')
-        
-        for _, arrival in arrivals.iterrows():
-            arr_time = arrival['Timestamp']
-            arr_node = arrival['NodeId']
-            arr_route = arrival['RouteId']
-            
-            other_route_deps = departures[
-                (departures['RouteId'] != arr_route) & 
-                (departures['Timestamp'] > arr_time) &
-                (departures['Timestamp'] - arr_time <= max_transfer_time)
-            ]
-            
-            for _, departure in other_route_deps.iterrows():
-                transfer_time = departure['Timestamp'] - arr_time
-                
-                if transfer_time >= CONFIG['MIN_TRANSFER_TIME']:
-                    chunk_links.append({
-                        'link_id': link_id,
-                        'from_node': arr_node,
-                        'to_node': departure['NodeId'],
-                        'duration': transfer_time,
-                        'mode': 'transfer'
-                    })
-                    link_id += 1
-                    link_count += 1
-                    
-                    if len(chunk_links) >= chunk_size:
-                        df_chunk = pd.DataFrame(chunk_links)
-                        df_chunk.to_csv(output_file, mode='a', header=False, index=False)
-                        chunk_links = []
-    
-    if chunk_links:
-        df_chunk = pd.DataFrame(chunk_links)
-        df_chunk.to_csv(output_file, mode='a', header=False, index=False)
-    
-    print(f"Created {link_count} TRANSFER links")
+    shards = split_shards(list(stop_data), max_workers)
+    state = {
+        'stop_data': stop_data,
+        'min_transfer_time': min_transfer_time,
+        'max_transfer_time': max_transfer_time
+    }
+    
+    for processed, links in enumerate(map_shards(transfer_links_for_stops, shards, state, max_workers), 1):
+        link_id = writer.write(link_id, *links, 'transfer')
+        print(f"  Processed shard {processed}/{len(shards)}...")
+    
+    print(f"Created {link_id - start_link_id} TRANSFER links")
     return link_id
 
-def append_walk_links_to_file(node_df, stop_info, stop_routes, output_file, start_link_id, 
-                             walking_radius, max_walk_wait_time):
-    """Create WALK links and append to file"""
-    print("\nCreating WALK links...")
-    print(f"Walking radius: {walking_radius}m, Max walk+wait time: {max_walk_wait_time}s")
-    
-    link_id = start_link_id
-    link_count = 0
-    chunk_size = 50000
-    chunk_links = []
-    
-    arrivals = node_df[node_df['Event'] == 'ARRIVAL'].copy()
-    print(f"Processing {len(arrivals)} arrival nodes...")
-    
-    departures_by_stop = {}
-    all_departures = node_df[node_df['Event'] == 'DEPARTURE']
-    for stop_id in all_departures['StopId'].unique():
-        departures_by_stop[stop_id] = all_departures[
-            all_departures['StopId'] == stop_id
-        ].sort_values('Timestamp')
-    
-    processed = 0
-    for idx, arrival in arrivals.iterrows():
-        processed += 1
-        if processed % 1000 == 0:
-            print(f"  Processed {processed}/{len(arrivals)} arrivals...")
-        
-        arr_stop = arrival['StopId']
-        arr_time = arrival['Timestamp']
-        arr_node = arrival['NodeId']
+def walk_links_for_stops(stop_ids):
+    """WALK links (from, to, duration) for arrivals at a shard of stops"""
+    stop_data = _worker_state['stop_data']
+    neighbor_index = _worker_state['neighbor_index']
+    stop_index = _worker_state['stop_index']
+    route_bits = _worker_state['route_bits']
+    walking_speed = _worker_state['walking_speed']
+    max_walk_wait_time = _worker_state['max_walk_wait_time']
+    from_parts, to_parts, duration_parts = [], [], []
+    
+    for arr_stop in stop_ids:
+        arr_data = stop_data[arr_stop]
+        arr_ts, arr_node = arr_data['arr_ts'], arr_data['arr_node']
+        if len(arr_ts) == 0:
+            continue
         
-        nearby_stops = find_stops_within_radius(arr_stop, stop_info, walking_radius)
+        # Neighbors and route mask are resolved once per stop, not once per arrival
+        nearby_ids, nearby_distances = neighbor_index[arr_stop]
+        arr_bits = route_bits[stop_index[arr_stop]]
         
-        for nearby in nearby_stops:
-            nearby_stop_id = nearby['StopId']
-            walk_distance = nearby['Distance']
-            walk_time = walk_distance / CONFIG['WALKING_SPEED']
-            
-            arr_routes = stop_routes[arr_stop]
-            nearby_routes = stop_routes[nearby_stop_id]
-            
-            if arr_routes & nearby_routes:
+        for nearby_stop_id, walk_distance in zip(nearby_ids, nearby_distances):
+            # Skip stops that share a route with the arrival stop
+            if (arr_bits & route_bits[stop_index[nearby_stop_id]]) != 0:
                 continue
             
-            if nearby_stop_id not in departures_by_stop:
+            nearby_data = stop_data.get(nearby_stop_id)
+            if nearby_data is None:
                 continue
-                
-            nearby_deps = departures_by_stop[nearby_stop_id]
             
-            earliest_dep_time = arr_time + walk_time
-            valid_deps = nearby_deps[
-                (nearby_deps['Timestamp'] >= earliest_dep_time) &
-                (nearby_deps['Timestamp'] - arr_time <= max_walk_wait_time)
-            ]
+            walk_time = walk_distance / walking_speed
+            dep_ts, dep_node = nearby_data['dep_ts'], nearby_data['dep_node']
+            
+            # Departures in [arr_time + walk_time, arr_time + max_walk_wait_time]
+            lo = np.searchsorted(dep_ts, arr_ts + walk_time, side='left')
+            hi = np.searchsorted(dep_ts, arr_ts + max_walk_wait_time, side='right')
+            arr_idx, dep_idx = expand_ranges(lo, hi)
             
-            for _, departure in valid_deps.iterrows():
-                total_time = departure['Timestamp'] - arr_time
-                
-                chunk_links.append({
-                    'link_id': link_id,
-                    'from_node': arr_node,
-                    'to_node': departure['NodeId'],
-                    'duration': total_time,
-                    'mode': 'walk'
-                })
-                link_id += 1
-                link_count += 1
-                
-                if len(chunk_links) >= chunk_size:
-                    df_chunk = pd.DataFrame(chunk_links)
-                    df_chunk.to_csv(output_file, mode='a', header=False, index=False)
-                    chunk_links = []
-    
-    if chunk_links:
-        df_chunk = pd.DataFrame(chunk_links)
-        df_chunk.to_csv(output_file, mode='a', header=False, index=False)
-    
-    print(f"Created {link_count} WALK links")
+            from_parts.append(arr_node[arr_idx])
+            to_parts.append(dep_node[dep_idx])
+            duration_parts.append(dep_ts[dep_idx] - arr_ts[arr_idx])
+    
+    return concat_links(from_parts, to_parts, duration_parts)
+
+def append_walk_links_to_file(stop_data, neighbor_index, stops, writer, start_link_id, 
+                             walking_radius, walking_speed, max_walk_wait_time, max_workers):
+    """Create WALK links and append to file"""
+    print("\nCreating WALK links...")
+    print(f"Walking radius: {walking_radius}m, Max walk+wait time: {max_walk_wait_time}s")
+    
+    link_id = start_link_id
+    
+    total_arrivals = sum(len(data['arr_ts']) for data in stop_data.values())
+    print(f"Processing {total_arrivals} arrival nodes...")
+    
+    shards = split_shards(list(stop_data), max_workers)
+    state = {
+        'stop_data': stop_data,
+        'neighbor_index': neighbor_index,
+        'stop_index': stops['index'],
+        'route_bits': stops['route_bits'],
+        'walking_speed': walking_speed,
+        'max_walk_wait_time': max_walk_wait_time
+    }
+    
+    for processed, links in enumerate(map_shards(walk_links_for_stops, shards, state, max_workers), 1):
+        link_id = writer.write(link_id, *links, 'walk')
+        print(f"  Processed shard {processed}/{len(shards)}...")
+    
+    print(f"Created {link_id - start_link_id} WALK links")
     return link_id
 
-def create_link_table_memory_optimized(node_csv, bus_json, output_csv, config=None):
-    """Main function - memory optimized version"""
+def create_link_table_memory_optimized(node_csv, bus_json, output_csv, config=None, save_graph=False):
+    """Main function - memory optimized version
+    
+    With save_graph, a binary igraph graph (.picklez) is also written next to the link table.
+    """
     print(f"\n=== CREATE LINK TABLE (MEMORY OPTIMIZED) ===")
     print(f"Node table: {node_csv}")
     print(f"Bus data: {bus_json}")
@@ -343,47 +640,88 @@ def create_link_table_memory_optimized(node_csv, bus_json, output_csv, config=No
     
     if config:
         CONFIG.update(config)
+    # Snapshot of the settings for this run; workers receive plain values, not CONFIG
+    cfg = SimpleNamespace(**CONFIG)
     
     print("\nConfiguration:")
-    for key, value in CONFIG.items():
+    for key, value in vars(cfg).items():
         print(f"  {key}: {value}")
     
+    fingerprint = source_fingerprint(node_csv, bus_json)
+    if is_link_table_current(output_csv, fingerprint):
+        print(f"\nLink table is up to date with its sources, skipping rebuild: {output_csv}")
+        graph_file = graph_file_for(output_csv)
+        if save_graph and not is_graph_current(graph_file, fingerprint):
+            metadata = pq.read_schema(output_csv).metadata
+            print("\nSaving graph binary...")
+            save_graph_binary(output_csv, graph_file,
+                              int(metadata[b'first_node_id']), int(metadata[b'last_node_id']), fingerprint)
+        return
+    
+    # A graph saved from the previous table no longer matches it
+    graph_file = graph_file_for(output_csv)
+    if os.path.exists(graph_file):
+        os.remove(graph_file)
+    
     # Load data
     print("\nLoading node table...")
-    node_df = pd.read_csv(node_csv, dtype={
+    node_dtypes = {
         'NodeId': 'int32',
         'RouteId': 'int32', 
         'StopId': 'int32',
         'Timestamp': 'int32',
-        'TripId': 'int32'
-    })
+        'TripId': 'int32',
+        'Event': 'category'
+    }
+    # Multi-threaded Arrow parser; text columns like StopName/Attributes are never parsed
+    node_df = pd.read_csv(node_csv, engine='pyarrow', usecols=list(node_dtypes), dtype=node_dtypes)
+    node_df['Event'] = node_df['Event'].map(EVENT_CODES).astype('int8')
     print(f"Loaded {len(node_df)} nodes")
     
-    stop_info, stop_routes = load_stop_info(bus_json)
+    if cfg.USE_MINIMAL_SAMPLE:
+        keep_routes = node_df['RouteId'].drop_duplicates().head(cfg.MINIMAL_ROUTE_COUNT)
+        node_df = node_df[node_df['RouteId'].isin(keep_routes)].reset_index(drop=True)
+        print(f"WARNING: minimal sample enabled, kept only {len(node_df)} nodes on {len(keep_routes)} routes; "
+              f"the link table does not cover the full network")
+    
+    stops = load_stop_info(bus_json)
+    neighbor_index = build_neighbor_index(stops, cfg.WALKING_RADIUS)
+    stop_data = build_stop_data(node_df)
     
     # Track total time
     total_start = time.time()
     
     # Create each type of link and write directly to file
+    first_node_id = int(node_df['NodeId'].min())
+    last_node_id = int(node_df['NodeId'].max())
+    writer = LinkWriter(output_csv, metadata={
+        'source_hash': fingerprint,
+        'first_node_id': str(first_node_id),
+        'last_node_id': str(last_node_id)
+    })
+    
     start_time = time.time()
-    next_link_id = create_bus_links_to_file(node_df, output_csv, 1)
+    next_link_id = create_bus_links_to_file(node_df, writer, 1)
     print(f"  Time: {time.time() - start_time:.1f}s")
     
     start_time = time.time()
-    next_link_id = append_wait_links_to_file(node_df, output_csv, next_link_id)
+    next_link_id = append_wait_links_to_file(node_df, writer, next_link_id, cfg.MAX_WORKERS)
     print(f"  Time: {time.time() - start_time:.1f}s")
     
     start_time = time.time()
-    next_link_id = append_transfer_links_to_file(node_df, output_csv, next_link_id, CONFIG['MAX_TRANSFER_TIME'])
+    next_link_id = append_transfer_links_to_file(
+        stop_data, writer, next_link_id, cfg.MIN_TRANSFER_TIME, cfg.MAX_TRANSFER_TIME, cfg.MAX_WORKERS
+    )
     print(f"  Time: {time.time() - start_time:.1f}s")
     
     start_time = time.time()
     final_link_id = append_walk_links_to_file(
-        node_df, stop_info, stop_routes, output_csv, next_link_id,
-        CONFIG['WALKING_RADIUS'], CONFIG['MAX_WALK_WAIT_TIME']
+        stop_data, neighbor_index, stops, writer, next_link_id,
+        cfg.WALKING_RADIUS, cfg.WALKING_SPEED, cfg.MAX_WALK_WAIT_TIME, cfg.MAX_WORKERS
     )
     print(f"  Time: {time.time() - start_time:.1f}s")
     
+    writer.close()
     total_links = final_link_id - 1
     
     print("\n" + "=" * 50)
@@ -393,27 +731,33 @@ def create_link_table_memory_optimized(node_csv, bus_json, output_csv, config=No
     print(f"\nOutput saved to: {output_csv}")
     print(f"File size: {os.path.getsize(output_csv) / 1024 / 1024:.1f} MB")
     
-    # Count by mode (sampling for speed)
-    print("\nCounting links by mode (sampling)...")
-    sample_df = pd.read_csv(output_csv, nrows=100000)
-    mode_ratios = sample_df['mode'].value_counts(normalize=True)
+    print("\nBreakdown by mode:")
+    for mode, count in writer.mode_counts.items():
+        print(f"  {mode:8} : {count:11,} ({count / max(total_links, 1) * 100:5.1f}%)")
     
-    print("\nEstimated breakdown by mode:")
-    for mode, ratio in mode_ratios.items():
-        estimated_count = int(total_links * ratio)
-        print(f"  {mode:8} : ~{estimated_count:10,} ({ratio*100:5.1f}%)")
+    if save_graph:
+        # Downstream analysis loads this with ig.Graph.Read_Picklez instead of reparsing the link table
+        print("\nSaving graph binary...")
+        save_graph_binary(output_csv, graph_file, first_node_id, last_node_id, fingerprint)
 
 def main():
-    if len(sys.argv) < 4:
-        print("Usage: python create_link_table_optimized.py <node_table.csv> <bus_data.json> <output_link_table.csv>")
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    flags = {arg for arg in sys.argv[1:] if arg.startswith('--')}
+    if len(args) < 3 or flags - {'--graph', '--sample'}:
+        print("Usage: python create_link_table_optimized.py [--graph] [--sample] <node_table.csv> <bus_data.json> <output_link_table.csv|.csv.gz|.parquet>")
+        print("  --graph   also save the link table as a binary igraph graph (.picklez)")
+        print(f"  --sample  only build links for the first {MINIMAL_ROUTE_COUNT} routes (quick test run)")
         sys.exit(1)
     
-    node_csv = sys.argv[1]
-    bus_json = sys.argv[2]
-    output_csv = sys.argv[3]
+    node_csv = args[0]
+    bus_json = args[1]
+    output_csv = args[2]
     
     try:
-        create_link_table_memory_optimized(node_csv, bus_json, output_csv)
+        # The CLI always builds the full network unless --sample is given, whatever config.py says
+        create_link_table_memory_optimized(node_csv, bus_json, output_csv,
+                                           config={'USE_MINIMAL_SAMPLE': '--sample' in flags},
+                                           save_graph='--graph' in flags)
     except Exception as e:
         print(f"\n❌ ERROR: {str(e)}")
         import traceback
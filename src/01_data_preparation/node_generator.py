@@ -4,14 +4,31 @@ Bus Node Table Generator
 Tạo bảng nodes cho NetworkX từ dữ liệu JSON tuyến xe buýt
 """
 
-import json
 import csv
+import json
+import logging
 import math
 from datetime import datetime
 import sys
 import os
+import numpy as np
+import pandas as pd
+from numba import njit
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from collections import defaultdict, deque
 from typing import List, Dict, Tuple, Optional
 
+try:
+    import orjson  # Parser JSON nhanh hơn nhiều so với json chuẩn
+except ImportError:
+    orjson = None
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from config import MAX_WORKERS, LOG_LEVEL
+
+logger = logging.getLogger('node_generator')
+
 # ===== CÁC THAM SỐ CÓ THỂ ĐIỀU CHỈNH =====
 WAITING_TIME = 30  # Thời gian chờ tại mỗi trạm (giây) - mặc định
 
@@ -29,174 +46,198 @@ OUTPUT_ENCODING = 'utf-8'  # Encoding cho file output
 SKIP_INVALID_TRIPS = True  # True = bỏ qua trips lỗi, False = dừng khi gặp lỗi
 MIN_AVG_SPEED = 1.0  # Tốc độ tối thiểu (m/s) ~ 3.6 km/h
 
+# Các cột của bảng nodes
+NODE_COLUMNS = ['NodeId', 'RouteId', 'RouteNo', 'RouteVarId', 'TripId',
+                'StopId', 'Timestamp', 'Event', 'Time', 'StopName', 'Attributes']
+
+# Mã event trong buffer cột
+ARRIVAL = 0
+DEPARTURE = 1
+EVENT_NAMES = np.array(['ARRIVAL', 'DEPARTURE'], dtype=object)
+
 # ==========================================
 
-def parse_time_to_seconds(time_str: str, is_next_day: bool = False) -> Optional[int]:
+def parse_times_to_seconds(time_strs: List[str]) -> np.ndarray:
     """
-    Chuyển đổi thời gian từ HH:MM sang số giây từ 00:00
+    Chuyển đổi cả danh sách thời gian "HH:MM" sang số giây từ 00:00
+    Chấp nhận khoảng trắng quanh giờ/phút, số 0 ở đầu và chữ số Unicode (vd: " 5 : 07", "0005:07");
+    giá trị không phải chuỗi, ngoài khoảng (vd: "24:00") hoặc có dấu/gạch dưới ("+5:00", "1_0:00") cho NaN
     
-    Args:
-        time_str: Thời gian dạng "HH:MM"
-        is_next_day: True nếu thời gian thuộc ngày hôm sau
-        
     Returns:
-        Số giây từ 00:00 hoặc None nếu không hợp lệ
+        Mảng float số giây từ 00:00, NaN nếu không hợp lệ
     """
-    if not time_str or not isinstance(time_str, str):
-        return None
+    times = pd.Series(time_strs, dtype=object)
+    times = times.where(times.map(lambda t: isinstance(t, str)), None)
+    parts = times.str.extract(r'^\s*(\d+)\s*:\s*(\d+)\s*$')
     
-    try:
-        time_str = time_str.strip()
-        parts = time_str.split(':')
-        if len(parts) != 2:
-            return None
-            
-        hours = int(parts[0])
-        minutes = int(parts[1])
-        
-        if hours < 0 or hours > 23 or minutes < 0 or minutes > 59:
-            return None
-        
-        seconds = hours * 3600 + minutes * 60
-        
-        # Nếu là ngày hôm sau, cộng thêm 24 giờ
-        if is_next_day:
-            seconds += 24 * 3600
-            
-        return seconds
-    except:
-        return None
+    # int() thay vì to_numeric để đọc được cả chữ số Unicode (vd: chữ số full-width)
+    hours = parts[0].map(int, na_action='ignore').astype(np.float64)
+    minutes = parts[1].map(int, na_action='ignore').astype(np.float64)
+    valid = (hours <= 23) & (minutes <= 59)
+    
+    return (hours * 3600 + minutes * 60).where(valid).to_numpy(dtype=np.float64, copy=True)
 
-def seconds_to_time(seconds: int) -> str:
+# Chuỗi "HH:MM:SS" cho mọi giây trong ngày, dùng cho seconds_to_time_vec
+TIME_OF_DAY_STRINGS = np.array([f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}" for s in range(24 * 3600)],
+                               dtype=object)
+
+def seconds_to_time_vec(seconds: np.ndarray) -> np.ndarray:
     """
-    Chuyển đổi số giây sang định dạng HH:MM:SS
-    Xử lý cả trường hợp qua ngày (> 24 giờ)
+    Chuyển đổi mảng số giây sang chuỗi "HH:MM:SS", giá trị qua ngày có thêm hậu tố "+Nd"
+    (vd: 90000 -> "01:00:00+1d"); số giây âm được tính là 00:00:00
+    Tra bảng chuỗi theo giây trong ngày, chỉ ghép hậu tố cho các giá trị qua ngày
     """
-    # Xử lý số giây âm hoặc quá lớn
-    if seconds < 0:
-        return "00:00:00"
-    
+    seconds = np.maximum(np.asarray(seconds, dtype=np.int64), 0)
     days = seconds // (24 * 3600)
-    remaining_seconds = seconds % (24 * 3600)
+    times = TIME_OF_DAY_STRINGS[seconds % (24 * 3600)]
     
-    hours = remaining_seconds // 3600
-    minutes = (remaining_seconds % 3600) // 60
-    secs = remaining_seconds % 60
+    next_day = days > 0
+    if next_day.any():
+        times[next_day] = [f"{t}+{d}d" for t, d in zip(times[next_day], days[next_day].tolist())]
     
-    if days > 0:
-        # Hiển thị ngày tiếp theo
-        return f"{hours:02d}:{minutes:02d}:{secs:02d}+{days}d"
-    else:
-        return f"{hours:02d}:{minutes:02d}:{secs:02d}"
+    return times
 
-def haversine_distance(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+def haversine_distance_vec(lat1, lng1, lat2, lng2) -> np.ndarray:
     """
-    Tính khoảng cách giữa 2 điểm trên Trái Đất (meters)
+    Tính khoảng cách haversine (meters) cho cả mảng điểm cùng lúc
+    Tọa độ tính bằng radian, hỗ trợ broadcasting (vd: 1 trạm với mọi điểm của path)
     """
     R = 6371000  # Bán kính Trái Đất (meters)
     
-    dlat = math.radians(lat2 - lat1)
-    dlng = math.radians(lng2 - lng1)
+    dlat = lat2 - lat1
+    dlng = lng2 - lng1
     
-    a = (math.sin(dlat/2)**2 + 
-         math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * 
-         math.sin(dlng/2)**2)
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlng/2)**2
     
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    return 2 * R * np.arcsin(np.sqrt(a))
+
+@njit(cache=True, fastmath=True)
+def nearest_index(stop_lat: float, stop_lng: float, lats: np.ndarray, lngs: np.ndarray) -> int:
+    """
+    Chỉ số điểm path gần trạm nhất (tọa độ radian)
+    Path chỉ trải vài km quanh trạm nên dùng xấp xỉ equirectangular (sai số < 0.1%),
+    so sánh bình phương khoảng cách, không cần lượng giác trong vòng lặp
+    """
+    cos_stop_lat = math.cos(stop_lat)
+    # Khởi tạo từ điểm 0 thay vì np.inf: fastmath giả định không có giá trị vô cực
+    dx = (lngs[0] - stop_lng) * cos_stop_lat
+    dy = lats[0] - stop_lat
+    min_d2 = dx * dx + dy * dy
+    min_i = 0
+    for i in range(1, lats.shape[0]):
+        dx = (lngs[i] - stop_lng) * cos_stop_lat
+        dy = lats[i] - stop_lat
+        d2 = dx * dx + dy * dy
+        if d2 < min_d2:
+            min_d2 = d2
+            min_i = i
+    return min_i
+
+def build_path_index(path_lats: List[float], path_lngs: List[float]) -> Dict:
+    """
+    Chuẩn bị path của một variant: tọa độ radian để tìm điểm gần nhất
+    và chiều dài cộng dồn cum_dist[i] từ điểm đầu path đến điểm i (meters)
+    """
+    lat_rad = np.radians(np.asarray(path_lats, dtype=np.float64))
+    lng_rad = np.radians(np.asarray(path_lngs, dtype=np.float64))
     
-    return R * c
+    segment_lengths = haversine_distance_vec(lat_rad[:-1], lng_rad[:-1], lat_rad[1:], lng_rad[1:])
+    
+    return {
+        'lats': path_lats,
+        'lngs': path_lngs,
+        'lat_rad': lat_rad,
+        'lng_rad': lng_rad,
+        'cum_dist': np.concatenate([[0.0], np.cumsum(segment_lengths)])
+    }
 
-def find_nearest_point_on_path(stop_lat: float, stop_lng: float, 
-                               path_lats: List[float], path_lngs: List[float]) -> Dict:
+def find_nearest_point_on_path(stop_lat: float, stop_lng: float, path: Dict) -> Dict:
     """
-    Tìm điểm gần nhất trên path với một trạm
+    Tìm điểm gần nhất trên path với một trạm (path từ build_path_index)
     """
-    min_distance = float('inf')
-    nearest_index = 0
+    stop_lat_rad = math.radians(stop_lat)
+    stop_lng_rad = math.radians(stop_lng)
+    nearest = nearest_index(stop_lat_rad, stop_lng_rad, path['lat_rad'], path['lng_rad'])
     
-    for i in range(len(path_lats)):
-        distance = haversine_distance(stop_lat, stop_lng, path_lats[i], path_lngs[i])
-        if distance < min_distance:
-            min_distance = distance
-            nearest_index = i
+    # Chỉ tính khoảng cách thật (meters) cho điểm tìm được
+    distance = haversine_distance_vec(stop_lat_rad, stop_lng_rad,
+                                      path['lat_rad'][nearest], path['lng_rad'][nearest])
     
     return {
-        'index': nearest_index,
-        'distance': min_distance,
-        'lat': path_lats[nearest_index],
-        'lng': path_lngs[nearest_index]
+        'index': nearest,
+        'distance': float(distance),
+        'lat': path['lats'][nearest],
+        'lng': path['lngs'][nearest]
     }
 
-def calculate_real_distance(stop1: Dict, stop2: Dict, 
-                          path_lats: List[float], path_lngs: List[float]) -> float:
+def calculate_real_distance(stop1: Dict, stop2: Dict, path: Dict) -> float:
     """
     Tính khoảng cách thực tế giữa 2 trạm dọc theo path
     """
-    nearest1 = find_nearest_point_on_path(stop1['Lat'], stop1['Lng'], path_lats, path_lngs)
-    nearest2 = find_nearest_point_on_path(stop2['Lat'], stop2['Lng'], path_lats, path_lngs)
+    nearest1 = find_nearest_point_on_path(stop1['Lat'], stop1['Lng'], path)
+    nearest2 = find_nearest_point_on_path(stop2['Lat'], stop2['Lng'], path)
     
-    start_idx = min(nearest1['index'], nearest2['index'])
-    end_idx = max(nearest1['index'], nearest2['index'])
-    
-    total_distance = 0.0
-    for i in range(start_idx, end_idx):
-        total_distance += haversine_distance(
-            path_lats[i], path_lngs[i],
-            path_lats[i + 1], path_lngs[i + 1]
-        )
+    cum_dist = path['cum_dist']
+    return float(abs(cum_dist[nearest2['index']] - cum_dist[nearest1['index']]))
+
+def build_route_lookups(route_data: Dict) -> Tuple[Dict, Dict]:
+    """
+    Tra cứu theo RouteVarId cho một tuyến: (variant theo id, danh sách timetables theo id)
+    """
+    vars_by_id = {v['RouteVarId']: v for v in route_data.get('getvarsbyroute', [])}
+    tt_by_var = defaultdict(list)
+    for t in route_data.get('gettimetablebyroute', []):
+        tt_by_var[t['RouteVarId']].append(t)
     
-    return total_distance
+    return vars_by_id, dict(tt_by_var)
 
 def process_route_variant(route_data: Dict, variant_id: int, 
                          route_id: int, route_no: str,
-                         global_node_id: int) -> Tuple[List[Dict], int]:
+                         vars_by_id: Dict, tt_by_var: Dict) -> Optional[pd.DataFrame]:
     """
     Xử lý một chiều (variant) của tuyến
     
     Returns:
-        (danh_sách_nodes, node_id_tiếp_theo)
+        DataFrame nodes của variant (chưa có NodeId, được đánh số sau khi gom tất cả variant)
+        hoặc None nếu variant bị bỏ qua
     """
-    nodes = []
+    nodes = None
     
     # Lấy loại bus để xác định thời gian chờ
     bus_type = route_data.get('getroutebyid', {}).get('Type', 'Unknown')
     waiting_time = WAITING_TIME_BY_TYPE.get(bus_type, WAITING_TIME)
     
     # Lấy thông tin variant
-    variant = None
-    for v in route_data.get('getvarsbyroute', []):
-        if v['RouteVarId'] == variant_id:
-            variant = v
-            break
+    variant = vars_by_id.get(variant_id)
     
     if not variant:
-        print(f"  ! Không tìm thấy variant {variant_id}")
-        return nodes, global_node_id
+        logger.warning("  ! Không tìm thấy variant %s", variant_id)
+        return nodes
     
     # Lấy stops và paths
     stops = route_data.get('getstopsbyvar', {}).get(str(variant_id), [])
     paths = route_data.get('getpathsbyvar', {}).get(str(variant_id), {})
     
     if not stops or not paths:
-        print(f"  ! Thiếu stops hoặc paths cho variant {variant_id}")
-        return nodes, global_node_id
+        logger.warning("  ! Thiếu stops hoặc paths cho variant %s", variant_id)
+        return nodes
     
     path_lats = paths.get('lat', [])
     path_lngs = paths.get('lng', [])
     
     if not path_lats or not path_lngs:
-        print(f"  ! Paths không có tọa độ cho variant {variant_id}")
-        return nodes, global_node_id
+        logger.warning("  ! Paths không có tọa độ cho variant %s", variant_id)
+        return nodes
     
     # Kiểm tra số lượng stops
     if len(stops) < 2:
-        print(f"  ! Variant {variant_id} chỉ có {len(stops)} stops, skip!")
-        return nodes, global_node_id
+        logger.warning("  ! Variant %s chỉ có %d stops, skip!", variant_id, len(stops))
+        return nodes
     
     # Kiểm tra path data
     if len(path_lats) < 2 or len(path_lngs) < 2:
-        print(f"  ! Variant {variant_id} không đủ path data (cần >=2 điểm), skip!")
-        return nodes, global_node_id
+        logger.warning("  ! Variant %s không đủ path data (cần >=2 điểm), skip!", variant_id)
+        return nodes
     
     # Kiểm tra loop route (tuyến vòng tròn)
     is_loop_route = False
@@ -205,18 +246,14 @@ def process_route_variant(route_data: Dict, variant_id: int,
         if (stops[0]['Lat'] == stops[1]['Lat'] and 
             stops[0]['Lng'] == stops[1]['Lng']):
             is_loop_route = True
-            print(f"  ! Variant {variant_id} là tuyến vòng tròn (loop route)")
+            logger.info("  ! Variant %s là tuyến vòng tròn (loop route)", variant_id)
     
     # Tính khoảng cách
+    path = build_path_index(path_lats, path_lngs)
     if is_loop_route:
-        # Với loop route, tính tổng chiều dài của path
-        total_distance = 0.0
-        for i in range(len(path_lats) - 1):
-            total_distance += haversine_distance(
-                path_lats[i], path_lngs[i],
-                path_lats[i + 1], path_lngs[i + 1]
-            )
-        print(f"    Loop distance (từ path): {total_distance:.0f}m")
+        # Với loop route, tổng chiều dài của path
+        total_distance = float(path['cum_dist'][-1])
+        logger.info("    Loop distance (từ path): %.0fm", total_distance)
         
         # Fake stop distances cho logic phía sau
         stop_distances = [total_distance]  # 1 khoảng cách duy nhất
@@ -224,34 +261,45 @@ def process_route_variant(route_data: Dict, variant_id: int,
         # Tính khoảng cách thông thường giữa các trạm
         stop_distances = []
         for i in range(len(stops) - 1):
-            distance = calculate_real_distance(stops[i], stops[i + 1], path_lats, path_lngs)
+            distance = calculate_real_distance(stops[i], stops[i + 1], path)
             stop_distances.append(distance)
         
         total_distance = sum(stop_distances)
     
     # Kiểm tra total_distance
     if total_distance <= 0:
-        print(f"  ! Variant {variant_id} có total_distance = {total_distance}m")
-        print(f"    Stops: {[(s['Name'], s['Lat'], s['Lng']) for s in stops[:3]]}")
-        print(f"    Path points: {len(path_lats)}")
+        logger.warning("  ! Variant %s có total_distance = %sm", variant_id, total_distance)
+        logger.warning("    Stops: %s", [(s['Name'], s['Lat'], s['Lng']) for s in stops[:3]])
+        logger.warning("    Path points: %d", len(path_lats))
         if not is_loop_route:
-            print(f"    Stop distances: {stop_distances[:5]}")
-        print(f"    => SKIP variant này!")
-        return nodes, global_node_id
+            logger.warning("    Stop distances: %s", stop_distances[:5])
+        logger.warning("    => SKIP variant này!")
+        return nodes
     
     # Lấy tất cả timetables cho variant này
-    timetables = [t for t in route_data.get('gettimetablebyroute', []) 
-                  if t['RouteVarId'] == variant_id]
+    timetables = tt_by_var.get(variant_id, [])
     
-    print(f"  - Variant {variant_id}: {variant['RouteVarName']}")
-    print(f"    Stops: {len(stops)}, Distance: {total_distance:.0f}m, Waiting: {waiting_time}s/stop")
-    print(f"    Bus type: {bus_type}, Timetables: {len(timetables)}")
+    logger.info("  - Variant %s: %s", variant_id, variant['RouteVarName'])
+    logger.info("    Stops: %d, Distance: %.0fm, Waiting: %ss/stop", len(stops), total_distance, waiting_time)
+    logger.info("    Bus type: %s, Timetables: %d", bus_type, len(timetables))
     if is_loop_route:
-        print(f"    Route type: Loop (vòng tròn)")
+        logger.info("    Route type: Loop (vòng tròn)")
+    
+    trips_by_timetable = [route_data.get('gettripsbytimetable', {}).get(str(t['TimeTableId']), [])
+                          for t in timetables]
+    
+    # Các trip hợp lệ; nodes được tạo 1 lần cho cả variant sau vòng lặp
+    valid_trip_ids = []
+    valid_starts = []
+    valid_ends = []
+    valid_speeds = []
+    
+    # Đếm trip bị bỏ qua theo lý do, in 1 dòng tổng kết cho cả variant
+    skip_counts = defaultdict(int)
+    overnight_trips = 0
     
     # Xử lý từng timetable
-    for timetable in timetables:
-        trips = route_data.get('gettripsbytimetable', {}).get(str(timetable['TimeTableId']), [])
+    for timetable, trips in zip(timetables, trips_by_timetable):
         
         if not trips:
             continue
@@ -259,30 +307,35 @@ def process_route_variant(route_data: Dict, variant_id: int,
         valid_trips = 0
         skipped_trips = 0
         
+        # Parse time của cả timetable 1 lần; NaN = thời gian không hợp lệ
+        trip_starts = parse_times_to_seconds([trip.get('StartTime') for trip in trips])
+        trip_ends = parse_times_to_seconds([trip.get('EndTime') for trip in trips])
+        
+        # Chuyến qua đêm (overnight trip): kết thúc <= bắt đầu
+        # Ví dụ: 21:00 -> 00:00 hoặc 22:30 -> 01:30 => EndTime thuộc ngày hôm sau
+        trip_overnight = trip_ends <= trip_starts
+        trip_ends[trip_overnight] += 24 * 3600
+        
         # Xử lý từng trip
-        for trip in trips:
-            # Parse time ban đầu
-            start_seconds = parse_time_to_seconds(trip.get('StartTime'))
-            end_seconds = parse_time_to_seconds(trip.get('EndTime'))
-            
+        for trip, start_seconds, end_seconds, is_overnight in zip(trips, trip_starts.tolist(), trip_ends.tolist(),
+                                                                   trip_overnight.tolist()):
             # Skip invalid trips
-            if start_seconds is None or end_seconds is None:
+            if math.isnan(start_seconds) or math.isnan(end_seconds):
                 if not SKIP_INVALID_TRIPS:
                     raise ValueError(f"Invalid time in trip {trip['TripId']}: "
                                    f"Start={trip.get('StartTime')}, End={trip.get('EndTime')}")
                 skipped_trips += 1
+                skip_counts['invalid time'] += 1
+                logger.debug("      ! Skip trip %s: invalid time Start=%s, End=%s",
+                             trip['TripId'], trip.get('StartTime'), trip.get('EndTime'))
                 continue
             
-            # Kiểm tra chuyến qua đêm (overnight trip)
-            is_overnight = False
-            if end_seconds <= start_seconds:
-                # Có thể là chuyến qua đêm
-                # Ví dụ: 21:00 -> 00:00 hoặc 22:30 -> 01:30
-                end_seconds_next_day = parse_time_to_seconds(trip.get('EndTime'), is_next_day=True)
-                if end_seconds_next_day:
-                    end_seconds = end_seconds_next_day
-                    is_overnight = True
-                    print(f"      Trip {trip['TripId']}: Overnight {trip.get('StartTime')} -> {trip.get('EndTime')} (next day)")
+            start_seconds = int(start_seconds)
+            end_seconds = int(end_seconds)
+            if is_overnight:
+                overnight_trips += 1
+                logger.debug("      Trip %s: Overnight %s -> %s (next day)",
+                             trip['TripId'], trip.get('StartTime'), trip.get('EndTime'))
             
             # Tính thời gian di chuyển
             total_waiting_time = (len(stops) - 1) * waiting_time
@@ -292,8 +345,9 @@ def process_route_variant(route_data: Dict, variant_id: int,
                 if not SKIP_INVALID_TRIPS:
                     raise ValueError(f"Invalid traveling time for trip {trip['TripId']}: {traveling_time}s")
                 skipped_trips += 1
-                print(f"      ! Skip trip {trip['TripId']}: traveling_time={traveling_time}s "
-                      f"(total_time={end_seconds-start_seconds}s, waiting={total_waiting_time}s)")
+                skip_counts['traveling_time <= 0'] += 1
+                logger.debug("      ! Skip trip %s: traveling_time=%ss (total_time=%ss, waiting=%ss)",
+                             trip['TripId'], traveling_time, end_seconds - start_seconds, total_waiting_time)
                 continue
             
             avg_speed = total_distance / traveling_time  # m/s
@@ -301,183 +355,287 @@ def process_route_variant(route_data: Dict, variant_id: int,
             # Kiểm tra tốc độ hợp lý
             if avg_speed < MIN_AVG_SPEED:
                 skipped_trips += 1
-                print(f"      ! Skip trip {trip['TripId']}: avg_speed={avg_speed:.2f}m/s "
-                      f"(< {MIN_AVG_SPEED}m/s)")
+                skip_counts[f'< {MIN_AVG_SPEED}m/s'] += 1
+                logger.debug("      ! Skip trip %s: avg_speed=%.2fm/s (< %sm/s)",
+                             trip['TripId'], avg_speed, MIN_AVG_SPEED)
                 continue
             
             # Kiểm tra tốc độ quá cao (> 80km/h)
             if avg_speed > 22.2:  # 80 km/h
                 skipped_trips += 1
-                print(f"      ! Skip trip {trip['TripId']}: avg_speed={avg_speed*3.6:.1f}km/h (> 80km/h)")
+                skip_counts['> 80km/h'] += 1
+                logger.debug("      ! Skip trip %s: avg_speed=%.1fkm/h (> 80km/h)", trip['TripId'], avg_speed * 3.6)
                 continue
             
             valid_trips += 1
-            
-            # Tạo nodes cho trip
-            current_time = start_seconds
-            
-            # Xử lý đặc biệt cho loop route
-            if is_loop_route:
-                # DEPARTURE từ điểm đầu
-                nodes.append({
-                    'NodeId': global_node_id,
-                    'RouteId': route_id,
-                    'RouteNo': route_no,
-                    'RouteVarId': variant_id,
-                    'TripId': trip['TripId'],
-                    'StopId': stops[0]['StopId'],
-                    'Timestamp': round(current_time),
-                    'Event': 'DEPARTURE',
-                    'Time': seconds_to_time(round(current_time)),
-                    'StopName': stops[0]['Name'],
-                    'Attributes': json.dumps([route_id, stops[0]['StopId'], round(current_time), 'DEPARTURE'])
-                })
-                global_node_id += 1
-                
-                # ARRIVAL tại điểm cuối (cùng vị trí nhưng sau 1 vòng)
-                current_time = end_seconds  # Dùng end time trực tiếp
-                nodes.append({
-                    'NodeId': global_node_id,
-                    'RouteId': route_id,
-                    'RouteNo': route_no,
-                    'RouteVarId': variant_id,
-                    'TripId': trip['TripId'],
-                    'StopId': stops[1]['StopId'],
-                    'Timestamp': round(current_time),
-                    'Event': 'ARRIVAL',
-                    'Time': seconds_to_time(round(current_time)),
-                    'StopName': stops[1]['Name'],
-                    'Attributes': json.dumps([route_id, stops[1]['StopId'], round(current_time), 'ARRIVAL'])
-                })
-                global_node_id += 1
-            else:
-                # Xử lý thông thường cho non-loop routes
-                for i, stop in enumerate(stops):
-                    if i == 0:
-                        # Trạm đầu: chỉ có DEPARTURE
-                        nodes.append({
-                            'NodeId': global_node_id,
-                            'RouteId': route_id,
-                            'RouteNo': route_no,
-                            'RouteVarId': variant_id,
-                            'TripId': trip['TripId'],
-                            'StopId': stop['StopId'],
-                            'Timestamp': round(current_time),
-                            'Event': 'DEPARTURE',
-                            'Time': seconds_to_time(round(current_time)),
-                            'StopName': stop['Name'],
-                            'Attributes': json.dumps([route_id, stop['StopId'], round(current_time), 'DEPARTURE'])
-                        })
-                        global_node_id += 1
-                    else:
-                        # Tính thời gian đến trạm
-                        distance_from_previous = stop_distances[i - 1]
-                        travel_time = distance_from_previous / avg_speed
-                        current_time += travel_time
-                        
-                        # ARRIVAL event
-                        nodes.append({
-                            'NodeId': global_node_id,
-                            'RouteId': route_id,
-                            'RouteNo': route_no,
-                            'RouteVarId': variant_id,
-                            'TripId': trip['TripId'],
-                            'StopId': stop['StopId'],
-                            'Timestamp': round(current_time),
-                            'Event': 'ARRIVAL',
-                            'Time': seconds_to_time(round(current_time)),
-                            'StopName': stop['Name'],
-                            'Attributes': json.dumps([route_id, stop['StopId'], round(current_time), 'ARRIVAL'])
-                        })
-                        global_node_id += 1
-                        
-                        # DEPARTURE event (không cho trạm cuối)
-                        if i < len(stops) - 1:
-                            current_time += waiting_time
-                            nodes.append({
-                                'NodeId': global_node_id,
-                                'RouteId': route_id,
-                                'RouteNo': route_no,
-                                'RouteVarId': variant_id,
-                                'TripId': trip['TripId'],
-                                'StopId': stop['StopId'],
-                                'Timestamp': round(current_time),
-                                'Event': 'DEPARTURE',
-                                'Time': seconds_to_time(round(current_time)),
-                                'StopName': stop['Name'],
-                                'Attributes': json.dumps([route_id, stop['StopId'], round(current_time), 'DEPARTURE'])
-                            })
-                            global_node_id += 1
+            valid_trip_ids.append(trip['TripId'])
+            valid_starts.append(start_seconds)
+            valid_ends.append(end_seconds)
+            valid_speeds.append(avg_speed)
         
         if trips:
-            print(f"    TimeTable {timetable['TimeTableId']}: {valid_trips} valid, {skipped_trips} skipped / {len(trips)} trips")
+            logger.info("    TimeTable %s: %d valid, %d skipped / %d trips",
+                        timetable['TimeTableId'], valid_trips, skipped_trips, len(trips))
+    
+    if skip_counts or overnight_trips:
+        skipped = ', '.join(f"{reason}: {count}" for reason, count in skip_counts.items()) or '0'
+        logger.info("    Variant %s: skipped trips (%s), overnight trips: %d", variant_id, skipped, overnight_trips)
+    
+    if not valid_trip_ids:
+        return nodes
+    
+    # Tạo nodes bằng hàm chuyên biệt cho từng loại tuyến
+    emit_fn = _emit_loop_variant if is_loop_route else _emit_linear_variant
+    trip_ids, stop_pos, timestamps, events = emit_fn(
+        np.array(valid_trip_ids, dtype=np.int64), np.array(valid_starts, dtype=np.int64),
+        np.array(valid_ends, dtype=np.int64), np.array(valid_speeds, dtype=np.float64),
+        stop_distances, waiting_time
+    )
+    
+    return _build_node_frame(route_id, route_no, variant_id, stops, trip_ids, stop_pos, timestamps, events)
+
+def _emit_loop_variant(trip_ids: np.ndarray, starts: np.ndarray, ends: np.ndarray, avg_speeds: np.ndarray,
+                       stop_distances: List[float], waiting_time: int) -> Tuple[np.ndarray, ...]:
+    """
+    Nodes của tuyến vòng: mỗi trip DEPARTURE tại điểm đầu lúc start,
+    ARRIVAL tại điểm cuối (cùng vị trí nhưng sau 1 vòng) lúc end
+    
+    Returns:
+        (trip_ids, stop_pos, timestamps, events) theo thứ tự node
+    """
+    n_trips = len(trip_ids)
+    return (np.repeat(trip_ids, 2),
+            np.tile(np.array([0, 1], dtype=np.int32), n_trips),
+            np.column_stack([starts, ends]).ravel(),
+            np.tile(np.array([DEPARTURE, ARRIVAL], dtype=np.int8), n_trips))
+
+def _emit_linear_variant(trip_ids: np.ndarray, starts: np.ndarray, ends: np.ndarray, avg_speeds: np.ndarray,
+                         stop_distances: List[float], waiting_time: int) -> Tuple[np.ndarray, ...]:
+    """
+    Nodes của tuyến thường: DEP trạm 0, ARR trạm 1, DEP trạm 1, ..., ARR trạm cuối
     
-    return nodes, global_node_id
+    Returns:
+        (trip_ids, stop_pos, timestamps, events) theo thứ tự node
+    """
+    n_stops = len(stop_distances) + 1
+    nodes_per_trip = 2 * n_stops - 2
+    trip_stop_pos = np.concatenate([[0], np.repeat(np.arange(1, n_stops, dtype=np.int32), 2)[:-1]])
+    trip_events = np.where(np.arange(nodes_per_trip) % 2 == 0, DEPARTURE, ARRIVAL).astype(np.int8)
+    
+    # Mỗi hàng là các bước thời gian xen kẽ [start, travel_1, wait, travel_2, wait, ...] của 1 trip;
+    # cộng dồn theo hàng = timestamp từng node (cùng thứ tự phép cộng như tính tuần tự)
+    steps = np.empty((len(trip_ids), nodes_per_trip), dtype=np.float64)
+    steps[:, 0] = starts
+    steps[:, 1::2] = np.asarray(stop_distances, dtype=np.float64) / avg_speeds[:, None]
+    steps[:, 2::2] = waiting_time
+    
+    return (np.repeat(trip_ids, nodes_per_trip),
+            np.tile(trip_stop_pos, len(trip_ids)),
+            np.rint(np.cumsum(steps, axis=1)).astype(np.int64).ravel(),
+            np.tile(trip_events, len(trip_ids)))
+
+def _build_node_frame(route_id: int, route_no: str, variant_id: int, stops: List[Dict],
+                      trip_ids: np.ndarray, stop_pos: np.ndarray, timestamps: np.ndarray,
+                      events: np.ndarray) -> pd.DataFrame:
+    """
+    Ghép các cột node thành DataFrame; thông tin trạm lấy theo vị trí trong stops
+    """
+    stop_ids = np.array([stop['StopId'] for stop in stops])
+    stop_names = np.array([stop['Name'] for stop in stops], dtype=object)
+    event_names = EVENT_NAMES[events]
+    
+    # Chuỗi JSON cố định dạng [route_id, stop_id, timestamp, "EVENT"], phần cố định dựng sẵn theo trạm
+    attr_templates = [f'[{route_id}, {stop_id}, %d, "%s"]' for stop_id in stop_ids.tolist()]
+    
+    return pd.DataFrame({
+        'RouteId': route_id,
+        'RouteNo': route_no,
+        'RouteVarId': variant_id,
+        'TripId': trip_ids,
+        'StopId': stop_ids[stop_pos],
+        'Timestamp': timestamps,
+        'Event': event_names,
+        'Time': seconds_to_time_vec(timestamps),
+        'StopName': stop_names[stop_pos],
+        'Attributes': [attr_templates[pos] % (ts, event)
+                       for pos, ts, event in zip(stop_pos.tolist(), timestamps.tolist(), event_names)]
+    })
+
+# Dữ liệu JSON dùng chung cho các worker process, gán trong init_worker()
+_worker_state = {}
+
+# Số task tối đa đang chờ kết quả trên mỗi worker
+TASKS_IN_FLIGHT_PER_WORKER = 4
+
+class _RecordCollector(logging.Handler):
+    """
+    Gom log record của 1 task để process cha ghi ra liền một khối, không xen kẽ giữa các worker
+    """
+    def __init__(self):
+        super().__init__()
+        self.records = []
+    
+    def emit(self, record: logging.LogRecord):
+        # Định dạng message ngay trong worker để record pickle được
+        record.msg = record.getMessage()
+        record.args = None
+        self.records.append(record)
+
+def setup_logging():
+    """
+    Cấu hình logging; mức log lấy từ biến môi trường LOG_LEVEL (mặc định theo config)
+    """
+    logging.basicConfig(format='%(message)s', stream=sys.stdout)
+    logger.setLevel(os.environ.get('LOG_LEVEL', LOG_LEVEL))
+
+def init_worker(data: Dict, route_lookups: Dict, log_level: Optional[int] = None):
+    # Chỉ process con của pool nhận log_level; chạy tuần tự thì giữ nguyên cấu hình logging của process gọi
+    if log_level is not None:
+        logger.setLevel(log_level)
+    _worker_state['data'] = data
+    _worker_state['route_lookups'] = route_lookups
+
+class _RowCollector:
+    """
+    Đích ghi cho csv.writer: mỗi lần writerow() gọi write() đúng 1 lần với cả dòng,
+    nên mỗi phần tử của rows là 1 node, kể cả khi trường có xuống dòng bên trong dấu nháy
+    """
+    def __init__(self):
+        self.rows = []
+        self.write = self.rows.append
+
+def process_variant_task(task: Tuple[str, int]) -> Tuple[Optional[List[str]], List[logging.LogRecord]]:
+    """
+    Xử lý 1 variant (route_key, variant_id) trong worker
+    
+    Returns:
+        (các dòng CSV của từng node, chưa có cột NodeId, hoặc None nếu variant bị bỏ qua;
+         log record của variant)
+    """
+    route_key, variant_id = task
+    route_data = _worker_state['data'][route_key]
+    
+    # Lấy RouteId và RouteNo
+    route_id = route_data.get('getroutebyid', {}).get('RouteId', int(route_key))
+    route_no = route_data.get('getroutebyid', {}).get('RouteNo', route_key)
+    
+    vars_by_id, tt_by_var = _worker_state['route_lookups'][route_key]
+    
+    collector = _RecordCollector()
+    logger.addHandler(collector)
+    logger.propagate = False
+    try:
+        variant_nodes = process_route_variant(route_data, variant_id, route_id, route_no, vars_by_id, tt_by_var)
+    finally:
+        logger.removeHandler(collector)
+        logger.propagate = True
+    
+    if variant_nodes is None:
+        return None, collector.records
+    
+    # Định dạng CSV trong worker (cùng dialect với DataFrame.to_csv); process cha chỉ cần thêm NodeId
+    rows = _RowCollector()
+    writer = csv.writer(rows, lineterminator='\r\n')
+    writer.writerows(zip(*(variant_nodes[column].tolist() for column in NODE_COLUMNS[1:])))
+    return rows.rows, collector.records
+
+def map_variants(tasks: List[Tuple[str, int]], data: Dict, route_lookups: Dict, max_workers: int):
+    """
+    Chạy process_variant_task cho mọi task, song song nếu max_workers > 1, trả kết quả theo thứ tự
+    
+    Chỉ giữ tối đa max_workers * TASKS_IN_FLIGHT_PER_WORKER task chưa lấy kết quả, để kết quả
+    không dồn lại trong bộ nhớ khi ghi file chậm hơn tốc độ xử lý
+    """
+    if max_workers > 1:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                 initargs=(data, route_lookups, logger.getEffectiveLevel())) as pool:
+            pending = deque()
+            for task in tasks:
+                if len(pending) >= max_workers * TASKS_IN_FLIGHT_PER_WORKER:
+                    yield pending.popleft().result()
+                pending.append(pool.submit(process_variant_task, task))
+            while pending:
+                yield pending.popleft().result()
+    else:
+        init_worker(data, route_lookups)
+        try:
+            yield from map(process_variant_task, tasks)
+        finally:
+            _worker_state.clear()
+
+def load_json(json_file: str) -> Dict:
+    """
+    Đọc file JSON bằng orjson nếu có, nếu không dùng json chuẩn
+    """
+    with open(json_file, 'rb') as f:
+        raw = f.read()
+    
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
 
 def process_all_routes(json_file: str, output_csv: str):
     """
     Xử lý tất cả các tuyến từ file JSON và xuất ra CSV
     """
-    print(f"\n=== BUS NODE TABLE GENERATOR ===")
-    print(f"Input: {json_file}")
-    print(f"Output: {output_csv}")
-    print(f"Waiting time: {WAITING_TIME}s")
-    print(f"Route limit: {ROUTE_LIMIT or 'All'}")
-    print(f"Skip invalid trips: {SKIP_INVALID_TRIPS}")
-    print("=" * 40)
+    logger.info("=== BUS NODE TABLE GENERATOR ===")
+    logger.info("Input: %s", json_file)
+    logger.info("Output: %s", output_csv)
+    logger.info("Waiting time: %ss", WAITING_TIME)
+    logger.info("Route limit: %s", ROUTE_LIMIT or 'All')
+    logger.info("Skip invalid trips: %s", SKIP_INVALID_TRIPS)
+    logger.info("=" * 40)
     
     # Load JSON
-    print("\nĐang đọc file JSON...")
-    with open(json_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    logger.info("Đang đọc file JSON...")
+    data = load_json(json_file)
     
     all_route_keys = list(data.keys())
     route_keys = all_route_keys[:ROUTE_LIMIT] if ROUTE_LIMIT else all_route_keys
     
-    print(f"Tổng số tuyến trong file: {len(all_route_keys)}")
-    print(f"Sẽ xử lý: {len(route_keys)} tuyến")
+    logger.info("Tổng số tuyến trong file: %d", len(all_route_keys))
+    logger.info("Sẽ xử lý: %d tuyến", len(route_keys))
     
-    # Process routes
-    all_nodes = []
-    global_node_id = 1
+    # Process routes: mỗi variant là 1 task độc lập
+    tasks = [(route_key, variant['RouteVarId'])
+             for route_key in route_keys
+             for variant in data[route_key].get('getvarsbyroute', [])]
+    logger.info("Sẽ xử lý: %d variants (%d process)", len(tasks), MAX_WORKERS)
     
-    for idx, route_key in enumerate(route_keys, 1):
-        route_data = data[route_key]
-        
-        # Lấy RouteId và RouteNo
-        route_id = route_data.get('getroutebyid', {}).get('RouteId', int(route_key))
-        route_no = route_data.get('getroutebyid', {}).get('RouteNo', route_key)
-        
-        print(f"\n[{idx}/{len(route_keys)}] Xử lý tuyến {route_no} (ID: {route_id})...")
-        
-        # Xử lý từng variant
-        variants = route_data.get('getvarsbyroute', [])
-        for variant in variants:
-            variant_id = variant['RouteVarId']
-            variant_nodes, global_node_id = process_route_variant(
-                route_data, variant_id, route_id, route_no, global_node_id
-            )
-            all_nodes.extend(variant_nodes)
+    # Tra cứu variant/timetable theo RouteVarId, dựng 1 lần cho mỗi tuyến
+    route_lookups = {route_key: build_route_lookups(data[route_key]) for route_key in route_keys}
+    
+    # Ghi CSV theo từng variant ngay khi có kết quả, không giữ toàn bộ nodes trong bộ nhớ
+    logger.info("Đang xử lý và ghi file CSV...")
+    total_nodes = 0
+    route_node_counts = {route_key: 0 for route_key in route_keys}
+    with open(output_csv, 'wb') as f:
+        f.write((','.join(NODE_COLUMNS) + '\r\n').encode(OUTPUT_ENCODING))
         
-        print(f"  => Đã tạo {len(variant_nodes)} nodes")
-    
-    # Write CSV
-    print(f"\nĐang ghi file CSV...")
-    with open(output_csv, 'w', newline='', encoding=OUTPUT_ENCODING) as f:
-        writer = csv.DictWriter(f, fieldnames=[
-            'NodeId', 'RouteId', 'RouteNo', 'RouteVarId', 'TripId', 
-            'StopId', 'Timestamp', 'Event', 'Time', 'StopName', 'Attributes'
-        ])
-        writer.writeheader()
-        writer.writerows(all_nodes)
+        for (route_key, _), (rows, records) in zip(tasks, map_variants(tasks, data, route_lookups, MAX_WORKERS)):
+            for record in records:
+                logger.handle(record)
+            if rows is None:
+                continue
+            
+            # Đánh số NodeId theo thứ tự tuyến/variant như khi xử lý tuần tự
+            f.write(''.join(['%d,%s' % (node_id, row) for node_id, row in enumerate(rows, total_nodes + 1)])
+                    .encode(OUTPUT_ENCODING))
+            
+            total_nodes += len(rows)
+            route_node_counts[route_key] += len(rows)
+    
+    for idx, (route_key, count) in enumerate(route_node_counts.items(), 1):
+        route_no = data[route_key].get('getroutebyid', {}).get('RouteNo', route_key)
+        logger.info("[%d/%d] Tuyến %s: %d nodes", idx, len(route_keys), route_no, count)
     
     # Summary
-    print("\n" + "=" * 40)
-    print(f"✅ HOÀN THÀNH!")
-    print(f"Tổng số nodes: {len(all_nodes):,}")
-    print(f"File output: {output_csv}")
-    print(f"Kích thước: {os.path.getsize(output_csv) / 1024 / 1024:.2f} MB")
-    print("=" * 40)
+    logger.info("=" * 40)
+    logger.info("✅ HOÀN THÀNH!")
+    logger.info("Tổng số nodes: %s", format(total_nodes, ','))
+    logger.info("File output: %s", output_csv)
+    logger.info("Kích thước: %.2f MB", os.path.getsize(output_csv) / 1024 / 1024)
+    logger.info("=" * 40)
 
 def main():
     """
@@ -491,6 +649,8 @@ def main():
         print("  python bus_node_generator.py bus_data.json node_table.csv")
         sys.exit(1)
     
+    setup_logging()
+    
     input_file = sys.argv[1]
     output_file = sys.argv[2] if len(sys.argv) > 2 else 'node_table.csv'
     
@@ -0,0 +1,106 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src' / '01_data_preparation'))
+from link_generator import (ARRIVAL, DEPARTURE, LinkWriter, append_transfer_links_to_file,
+                            append_wait_links_to_file, append_walk_links_to_file,
+                            build_neighbor_index, build_stop_data, create_bus_links_to_file,
+                            expand_ranges)
+
+# Stop -> (lat, lng, routes); F is ~120m from D, every other pair is > 400m apart
+TINY_STOPS = {
+    1: (10.77, 106.700, [1]),     # A
+    2: (10.77, 106.705, [1]),     # B
+    3: (10.77, 106.710, [1, 2]),  # C
+    4: (10.77, 106.715, [1]),     # D
+    5: (10.77, 106.730, [2]),     # E
+    6: (10.77, 106.7161, [3]),    # F
+    7: (10.77, 106.760, [3]),     # G
+}
+
+# (NodeId, RouteId, TripId, StopId, Timestamp, Event) in node generator order
+TINY_NODES = [
+    # Route 1: B -> C takes 0s (both stops snap to the same path point)
+    (1, 1, 10, 1, 0, DEPARTURE), (2, 1, 10, 2, 100, ARRIVAL), (3, 1, 10, 2, 130, DEPARTURE),
+    (4, 1, 10, 3, 130, ARRIVAL), (5, 1, 10, 3, 160, DEPARTURE), (6, 1, 10, 4, 300, ARRIVAL),
+    (7, 1, 11, 1, 600, DEPARTURE), (8, 1, 11, 2, 700, ARRIVAL), (9, 1, 11, 2, 730, DEPARTURE),
+    (10, 1, 11, 3, 730, ARRIVAL), (11, 1, 11, 3, 760, DEPARTURE), (12, 1, 11, 4, 900, ARRIVAL),
+    # Route 2 leaves C 270s and 70s (< MIN_TRANSFER_TIME) after trip 10 arrives
+    (13, 2, 20, 3, 400, DEPARTURE), (14, 2, 20, 5, 500, ARRIVAL),
+    (15, 2, 21, 3, 200, DEPARTURE), (16, 2, 21, 5, 300, ARRIVAL),
+    # Route 3 leaves F, a short walk from D
+    (17, 3, 30, 6, 600, DEPARTURE), (18, 3, 30, 7, 700, ARRIVAL),
+]
+
+
+def tiny_stops():
+    route_bits = [sum(1 << route for route in routes) for _, _, routes in TINY_STOPS.values()]
+    return {
+        'stop_ids': np.array(list(TINY_STOPS), dtype=np.int32),
+        'lat': np.radians([lat for lat, _, _ in TINY_STOPS.values()]),
+        'lon': np.radians([lng for _, lng, _ in TINY_STOPS.values()]),
+        'route_bits': route_bits,
+        'index': {stop_id: i for i, stop_id in enumerate(TINY_STOPS)}
+    }
+
+
+def tiny_links(tmp_path):
+    """Run every link builder on the tiny network, return {mode: {(from, to, duration)}}"""
+    node_df = pd.DataFrame(TINY_NODES, columns=['NodeId', 'RouteId', 'TripId', 'StopId', 'Timestamp', 'Event'])
+    node_df = node_df.astype({'NodeId': 'int32', 'RouteId': 'int32', 'TripId': 'int32',
+                              'StopId': 'int32', 'Timestamp': 'int32', 'Event': 'int8'})
+    stops = tiny_stops()
+    stop_data = build_stop_data(node_df)
+    
+    output_file = str(tmp_path / 'links.csv')
+    writer = LinkWriter(output_file)
+    link_id = create_bus_links_to_file(node_df, writer, 1)
+    link_id = append_wait_links_to_file(node_df, writer, link_id, 1)
+    link_id = append_transfer_links_to_file(stop_data, writer, link_id, 120, 1800, 1)
+    append_walk_links_to_file(stop_data, build_neighbor_index(stops, 400), stops, writer, link_id,
+                              400, 1.2, 3600, 1)
+    writer.close()
+    
+    links = pd.read_csv(output_file)
+    assert links['link_id'].tolist() == list(range(1, len(links) + 1))
+    return {mode: set(map(tuple, group[['from_node', 'to_node', 'duration']].to_numpy().tolist()))
+            for mode, group in links.groupby('mode')}
+
+
+def test_expand_ranges_matches_python_loop():
+    lo = np.array([2, 0, 5, 7, 3])
+    hi = np.array([5, 0, 6, 4, 3])
+    owners, indices = expand_ranges(lo, hi)
+    
+    expected = [(i, j) for i in range(len(lo)) for j in range(lo[i], hi[i])]
+    assert list(zip(owners.tolist(), indices.tolist())) == expected
+
+
+def test_expand_ranges_empty():
+    owners, indices = expand_ranges(np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+    assert len(owners) == 0
+    assert len(indices) == 0
+
+
+def test_expand_ranges_all_empty_ranges():
+    owners, indices = expand_ranges(np.array([4, 2]), np.array([4, 1]))
+    assert len(owners) == 0
+    assert len(indices) == 0
+
+
+def test_link_builders_on_tiny_network(tmp_path):
+    links = tiny_links(tmp_path)
+    
+    assert set(links) == {'bus', 'wait', 'transfer', 'walk'}
+    # Each departure links to the next node of its trip, a 0s segment included
+    assert links['bus'] == {(1, 2, 100), (3, 4, 0), (5, 6, 140), (7, 8, 100), (9, 10, 0), (11, 12, 140),
+                            (13, 14, 100), (15, 16, 100), (17, 18, 100)}
+    # Arrival -> every strictly later departure of the same route at the same stop
+    assert links['wait'] == {(2, 3, 30), (2, 9, 630), (8, 9, 30), (4, 5, 30), (4, 11, 630), (10, 11, 30)}
+    # Arrival -> departure of another route at the same stop, within [120s, 1800s]
+    assert links['transfer'] == {(4, 13, 270)}
+    # Arrival at D -> departure from F (~120m, no shared route) after the walk, within 3600s
+    assert links['walk'] == {(6, 17, 300)}
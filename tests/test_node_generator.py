@@ -0,0 +1,114 @@
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src' / '01_data_preparation'))
+import node_generator
+from node_generator import (ARRIVAL, DEPARTURE, _emit_linear_variant,
+                            parse_times_to_seconds, seconds_to_time_vec)
+
+
+def tiny_route(stop_names):
+    """1 tuyến, 1 variant, các trạm cách nhau ~500m trên đường thẳng, 2 trip"""
+    lngs = [106.700 + 0.0046 * i for i in range(len(stop_names))]
+    path_lngs = np.linspace(lngs[0], lngs[-1], 50).tolist()
+    return {
+        'getroutebyid': {'RouteId': 7, 'RouteNo': '07', 'Type': 'Test'},
+        'getvarsbyroute': [{'RouteVarId': 701, 'RouteVarName': 'R07 dir 0'}],
+        'getstopsbyvar': {'701': [{'StopId': 70 + i, 'Lat': 10.77, 'Lng': lng, 'Name': name}
+                                  for i, (lng, name) in enumerate(zip(lngs, stop_names))]},
+        'getpathsbyvar': {'701': {'lat': [10.77] * len(path_lngs), 'lng': path_lngs}},
+        'gettimetablebyroute': [{'TimeTableId': 7001, 'RouteVarId': 701}],
+        'gettripsbytimetable': {'7001': [{'TripId': 1, 'StartTime': '06:00', 'EndTime': '06:10'},
+                                         {'TripId': 2, 'StartTime': '06:30', 'EndTime': '06:40'}]}
+    }
+
+
+def sequential_linear_nodes(trip_ids, starts, avg_speeds, stop_distances, waiting_time):
+    """Node loop of the original per-trip implementation: (trip_id, stop_pos, timestamp, event)"""
+    nodes = []
+    for trip_id, start, avg_speed in zip(trip_ids, starts, avg_speeds):
+        current_time = start
+        nodes.append((trip_id, 0, round(current_time), DEPARTURE))
+        for pos, distance in enumerate(stop_distances, 1):
+            current_time += distance / avg_speed
+            nodes.append((trip_id, pos, round(current_time), ARRIVAL))
+            if pos < len(stop_distances):
+                current_time += waiting_time
+                nodes.append((trip_id, pos, round(current_time), DEPARTURE))
+    return nodes
+
+
+def test_emit_linear_variant_matches_sequential_loop():
+    trip_ids = np.array([11, 12, 13], dtype=np.int64)
+    starts = np.array([19800, 21600, 86100], dtype=np.int64)
+    ends = np.array([21000, 23000, 87900], dtype=np.int64)
+    avg_speeds = np.array([4.7, 5.3, 6.1])
+    stop_distances = [312.5, 480.0, 127.3, 905.9]
+    
+    columns = _emit_linear_variant(trip_ids, starts, ends, avg_speeds, stop_distances, 30)
+    
+    expected = sequential_linear_nodes(trip_ids.tolist(), starts.tolist(), avg_speeds.tolist(), stop_distances, 30)
+    assert list(zip(*(column.tolist() for column in columns))) == expected
+
+
+def test_parse_times_to_seconds():
+    parsed = parse_times_to_seconds(['05:30', ' 23:59 ', '00:00', '5:07'])
+    assert parsed.tolist() == [19800, 86340, 0, 18420]
+
+
+def test_parse_times_to_seconds_lenient_like_int():
+    # Giống int(): khoảng trắng quanh giờ/phút, số 0 ở đầu và chữ số full-width vẫn hợp lệ
+    parsed = parse_times_to_seconds(['5: 07', '05 :07', ' 5 : 07', '0005:07', '\uff10\uff15:\uff10\uff17'])
+    assert parsed.tolist() == [18420] * 5
+
+
+def test_parse_times_to_seconds_invalid_is_nan():
+    parsed = parse_times_to_seconds(['+5:00', '-0:30', '1_0:00', '24:00', '12:60', '5:07:00', '',
+                                     'abc', None, 930])
+    assert np.isnan(parsed).all()
+
+
+def test_overnight_end_time():
+    # Chuyến qua đêm: End < Start, End được cộng thêm 1 ngày và hiển thị với hậu tố +1d
+    start, end = parse_times_to_seconds(['23:30', '00:15'])
+    assert end < start
+    assert seconds_to_time_vec(np.array([end + 24 * 3600])).tolist() == ['00:15:00+1d']
+
+
+def test_seconds_to_time_vec():
+    times = seconds_to_time_vec(np.array([0, 59, 3661, 86399]))
+    assert times.tolist() == ['00:00:00', '00:00:59', '01:01:01', '23:59:59']
+
+
+def test_seconds_to_time_vec_next_day_suffix():
+    times = seconds_to_time_vec(np.array([86400, 90061, 2 * 86400 + 5]))
+    assert times.tolist() == ['00:00:00+1d', '01:01:01+1d', '00:00:05+2d']
+
+
+def test_seconds_to_time_vec_negative_clamped():
+    assert seconds_to_time_vec(np.array([-1, -90000])).tolist() == ['00:00:00', '00:00:00']
+
+
+def test_seconds_to_time_vec_truncates_float_seconds():
+    # Timestamp đã được làm tròn trước khi định dạng; giá trị float chỉ bị cắt phần lẻ
+    assert seconds_to_time_vec(np.array([59.9, 60.0])).tolist() == ['00:00:59', '00:01:00']
+
+
+def test_process_all_routes_keeps_rows_with_line_breaks(tmp_path, monkeypatch):
+    # Tên trạm có CRLF được đặt trong dấu nháy, không được tách thành 2 node
+    stop_names = ['Ben xe\r\nMien Dong', 'Stop, "B"', 'Stop C']
+    json_file = tmp_path / 'bus.json'
+    json_file.write_text(json.dumps({'7': tiny_route(stop_names)}), encoding='utf-8')
+    output_csv = tmp_path / 'nodes.csv'
+    monkeypatch.setattr(node_generator, 'MAX_WORKERS', 1)
+    
+    node_generator.process_all_routes(str(json_file), str(output_csv))
+    
+    nodes = pd.read_csv(output_csv, keep_default_na=False)
+    assert nodes.columns.tolist() == node_generator.NODE_COLUMNS
+    assert nodes['NodeId'].tolist() == list(range(1, 9))
+    assert nodes['StopName'].tolist() == [stop_names[pos] for pos in [0, 1, 1, 2]] * 2